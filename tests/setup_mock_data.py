@@ -1,5 +1,7 @@
 """Functions to generate mock data files for tests"""
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import numpy as np
 import nibabel as nib
 import nibabel.cifti2 as ci
@@ -25,7 +27,11 @@ def atlas_to_func(img, out, n=10):
         Number of timepoints to generate, by default 100
     """
     img = nib.load(img)
-    out_img = nib.concat_images([img] * n)
+    arr = np.asanyarray(img.dataobj)
+    # view of the volume repeated along a new 4th axis, rather than stacking
+    # n copies in memory
+    arr = np.broadcast_to(arr[..., np.newaxis], arr.shape + (n,))
+    out_img = nib.Nifti1Image(arr, img.affine, img.header)
     out_img.to_filename(out)
     return out
 
@@ -45,9 +51,9 @@ def atlas_to_mask(img, label, out=None):
 
     if isinstance(img,str):
         img = nib.load(img)
-    arr = img.get_fdata().copy()
-    mask = np.where(arr == label, label, 0)
-    out_img = nib.Nifti1Image(mask, affine=img.affine)
+    arr = np.asanyarray(img.dataobj)
+    mask = (arr == label).astype(arr.dtype) * label
+    out_img = nib.Nifti1Image(mask, img.affine, img.header)
     if out is None:
         return out_img
     else:
@@ -64,12 +70,14 @@ def atlas_labels_to_prob(atlas,out):
         File name of 3D label/atlas image
     """
     atlas = nib.load(atlas)
-    n_regions = len(np.unique(atlas.get_fdata())) - 1
-    mask_imgs = []
-    for i in range(1,n_regions+1):
-        img = atlas_to_mask(atlas,i)
-        mask_imgs.append(img)
-    out_atlas = nib.concat_images(mask_imgs)
+    arr = np.asanyarray(atlas.dataobj)
+    n_regions = len(np.unique(arr)) - 1
+    # build all single-region masks in one broadcast instead of concatenating
+    # per-region images
+    labels = np.arange(1, n_regions + 1, dtype=arr.dtype)
+    arr = arr[..., np.newaxis]
+    masks = np.where(arr == labels, arr, 0)
+    out_atlas = nib.Nifti1Image(masks, affine=atlas.affine)
     if  out is None:
         return out_atlas
     else:
@@ -79,6 +87,16 @@ def atlas_labels_to_prob(atlas,out):
 
 ## Gifti
 
+@lru_cache(maxsize=8)
+def _read_annot(annot_file):
+    """Read a FreeSurfer annotation file, caching the result for reuse
+
+    The returned arrays are shared between callers and must not be modified
+    in place.
+    """
+    return nib.freesurfer.read_annot(annot_file)
+
+
 def make_binary_annot(annot_file, label, out):
     """Create a single-region annotation file
 
@@ -91,8 +109,8 @@ def make_binary_annot(annot_file, label, out):
     out : str
         File name of output .annot
     """
-    annot = nib.freesurfer.read_annot(annot_file)
-    mask = np.where(annot[0] == label, 1, 0)
+    annot = _read_annot(annot_file)
+    mask = (annot[0] == label).astype(np.int32)
 
     ctab = np.array([[25, 25, 25, 0], [255, 255, 255, 255]])
     names = ['background', 'mask']
@@ -116,13 +134,13 @@ def annot_to_func(annot_file, out, n=10):
     n : int, optional
         Number of timepoints to generate, by default 100
     """
-    annot = nib.freesurfer.read_annot(annot_file)
-    darrays = []
-    for i in range(n):
-        x = nib.gifti.GiftiDataArray(annot[0], 
-                                     intent='NIFTI_INTENT_TIME_SERIES',
-                                     datatype='NIFTI_TYPE_FLOAT32')
-        darrays.append(x)
+    annot = _read_annot(annot_file)
+    # all darrays share the same float32 buffer
+    payload = annot[0].astype(np.float32)
+    darrays = [nib.gifti.GiftiDataArray(payload,
+                                        intent='NIFTI_INTENT_TIME_SERIES',
+                                        datatype='NIFTI_TYPE_FLOAT32')
+               for _ in range(n)]
     img = nib.GiftiImage(darrays=darrays)
     img.to_filename(out)
     return out
@@ -142,16 +160,20 @@ def annot_to_gifti(annot_file, out):
         File name of output .label.gii
 
     """
-    labels, ctab, names = nib.freesurfer.read_annot(annot_file)
+    labels, ctab, names = _read_annot(annot_file)
 
     darr = nib.gifti.GiftiDataArray(labels, intent='NIFTI_INTENT_LABEL',
                                     datatype='NIFTI_TYPE_INT32')
     labeltable = nib.gifti.GiftiLabelTable()
-    for key, label in enumerate(names):
-        (r, g, b), a = (ctab[key, :3] / 255), (1.0 if key != 0 else 0.0)
+    # normalize all colours in one operation rather than per label
+    rgb = ctab[:, :3] / 255
+    glabels = []
+    for key, (label, (r, g, b)) in enumerate(zip(names, rgb)):
+        a = 1.0 if key != 0 else 0.0
         glabel = nib.gifti.GiftiLabel(key, r, g, b, a)
         glabel.label = label.decode()
-        labeltable.labels.append(glabel)
+        glabels.append(glabel)
+    labeltable.labels.extend(glabels)
 
     img = nib.GiftiImage(darrays=[darr], labeltable=labeltable)
     img.to_filename(out)
@@ -164,7 +186,7 @@ def make_binary_gifti(img, label, out):
     arr = img.agg_data().ravel()
     labeltable = img.labeltable.get_labels_as_dict()
 
-    mask = np.where(arr == label, label, 0)
+    mask = (arr == label).astype(arr.dtype) * label
 
     darray = nib.gifti.GiftiDataArray(mask, intent='NIFTI_INTENT_LABEL',
                                       datatype='NIFTI_TYPE_INT32')
@@ -174,8 +196,7 @@ def make_binary_gifti(img, label, out):
     retained_labels = [x for x in img.labeltable.labels if x.key in mask_labels]
 
     new_labels = nib.gifti.GiftiLabelTable()
-    for i in retained_labels:
-        new_labels.labels.append(i)
+    new_labels.labels.extend(retained_labels)
 
     img = nib.GiftiImage(darrays=[darray], labeltable=new_labels)
     img.to_filename(out)
@@ -204,8 +225,9 @@ def dlabel_to_dtseries(dlabel, out, n=10):
     dlabel = nib.load(dlabel)
 
     # imitate data with TR=2
-    label_array = dlabel.get_fdata().ravel()
-    tseries = np.tile(label_array, (n, 1))
+    label_array = np.asarray(dlabel.dataobj, dtype=np.float32).ravel()
+    # rows are identical, so a read-only view avoids an n-fold copy
+    tseries = np.broadcast_to(label_array, (n, label_array.size))
     data_map = ci.Cifti2MatrixIndicesMap(
         applies_to_matrix_dimension=(0, ), 
         indices_map_to_data_type='CIFTI_INDEX_TYPE_SERIES',
@@ -249,8 +271,8 @@ def dlabel_atlas_to_mask(dlabel, label, out):
         File name of output .dlabel.nii
     """
     dlabel = nib.load(dlabel)
-    arr = dlabel.get_fdata()
-    mask = np.where(arr == label, label, 0)
+    arr = np.asarray(dlabel.dataobj, dtype=np.float32)
+    mask = (arr == label).astype(arr.dtype) * label
     mask_img = ci.Cifti2Image(mask, header=dlabel.header)
     mask_img.to_filename(out)
     return out
@@ -283,11 +305,14 @@ def yeo_to_91k(dlabel, medial_wall, reference, out):
     ref = nib.load(reference)
 
     # remove medial wall vertices
-    array = dlabel.get_fdata()
-    corrected_array = array[np.logical_not(medial_wall.get_fdata())]
+    array = np.asarray(dlabel.dataobj, dtype=np.float32)
+    # compare against zero to get the non-medial wall mask in a single pass,
+    # rather than casting to bool and then inverting
+    cortex = np.asanyarray(medial_wall.dataobj) == 0
+    corrected_array = array[cortex]
 
     # expand to 91k
-    grayordinates = np.zeros(ref.shape)
+    grayordinates = np.zeros(ref.shape, dtype=corrected_array.dtype)
     grayordinates[0, :corrected_array.shape[0]] = corrected_array
     
     # make header
@@ -319,6 +344,16 @@ def yeo_to_91k(dlabel, medial_wall, reference, out):
     return out
 
 
+def _run_steps(steps):
+    """Run a sequence of (function, args) steps in order
+
+    Steps that depend on each other's outputs are grouped so that they run
+    sequentially within a single worker process.
+    """
+    for func, args in steps:
+        func(*args)
+
+
 def main():
 
     print('Setting up mock data...')
@@ -327,61 +362,67 @@ def main():
     ## NIfTIs
     schaef_3d = 'data/Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz'
     schaef_4d = 'data/mock/schaefer_func.nii.gz'
-    atlas_to_func(schaef_3d, schaef_4d)
     schaef_nifti_mask = 'data/mock/schaefer_LH_Vis_4.nii.gz'
-    atlas_to_mask(schaef_3d, 4, schaef_nifti_mask)
     schaef_prob = 'data/mock/schaefer_prob.nii.gz'
-    atlas_labels_to_prob(schaef_3d,schaef_prob)
 
     ## GIfTIs
     lh_annot = 'data/lh.Schaefer2018_100Parcels_7Networks_order.annot'
     rh_annot = 'data/rh.Schaefer2018_100Parcels_7Networks_order.annot'
-
     schaefer_LH_Vis_4_annot = 'data/mock/schaefer_LH_Vis_4.annot'
-    make_binary_annot(lh_annot, 4, schaefer_LH_Vis_4_annot)
-
     schaefer_RH_Vis_4_annot = 'data/mock/schaefer_RH_Vis_4.annot'
-    make_binary_annot(rh_annot, 4, schaefer_RH_Vis_4_annot)
-
     lh_label = 'data/mock/schaefer_hemi-L.label.gii'
-    annot_to_gifti(lh_annot, lh_label)
     rh_label = 'data/mock/schaefer_hemi-R.label.gii'
-    annot_to_gifti(rh_annot, rh_label)
-
     schaefer_LH_Vis_4_label = 'data/mock/schaefer_LH_Vis_4.label.gii'
-    make_binary_gifti(lh_label, 4, schaefer_LH_Vis_4_label)
-
     schaefer_RH_Vis_4_label = 'data/mock/schaefer_RH_Vis_4.label.gii'
-    make_binary_gifti(rh_label, 4, schaefer_RH_Vis_4_label)
-
     lh_func = 'data/mock/schaefer_hemi-L.func.gii'
-    annot_to_func(lh_annot, lh_func)
     rh_func = 'data/mock/schaefer_hemi-R.func.gii'
-    annot_to_func(rh_annot, rh_func)
 
     ## CIfTIs
     schaef_cifti =  'data/Schaefer2018_100Parcels_7Networks_order.dlabel.nii'
     gordon_cifti = 'data/Gordon333_FreesurferSubcortical.32k_fs_LR.dlabel.nii'
     mwall = 'data/Human.MedialWall_Conte69.32k_fs_LR.dlabel.nii'
-    
     schaef_91k = 'data/mock/schaefer_91k.dlabel.nii'
-    schaef_91k = yeo_to_91k(schaef_cifti, mwall, gordon_cifti, schaef_91k)
-
     schaef_91k_dtseries = 'data/mock/schaefer_91k.dtseries.nii'
-    dlabel_to_dtseries(schaef_91k, schaef_91k_dtseries)
-
     schaef_dtseries = 'data/mock/schaefer.dtseries.nii'
-    dlabel_to_dtseries(schaef_cifti, schaef_dtseries)
-
     gordon_dtseries = 'data/mock/gordon.dtseries.nii'
-    dlabel_to_dtseries(gordon_cifti, gordon_dtseries)
-
     schaefer_LH_Vis_4_mask = 'data/mock/schaefer_LH_Vis_4.dlabel.nii'
-    dlabel_atlas_to_mask(schaef_cifti, 4, schaefer_LH_Vis_4_mask)
-
     gordon_L_SMhand_10_mask = 'data/mock/gordon_L_SMhand_10.dlabel.nii'
-    dlabel_atlas_to_mask(gordon_cifti, 273, gordon_L_SMhand_10_mask)
+
+    # each job writes its own outputs, so jobs can run in parallel. Annotation
+    # builders are grouped per hemisphere to share the cached annot read.
+    # Workers get file names and load inputs themselves; keep_file_open is not
+    # used since the CIFTIs are uncompressed and each compressed NIfTI is read
+    # once per job
+    jobs = [
+        [(atlas_to_func, (schaef_3d, schaef_4d))],
+        [(atlas_to_mask, (schaef_3d, 4, schaef_nifti_mask))],
+        [(atlas_labels_to_prob, (schaef_3d, schaef_prob))],
+        [(make_binary_annot, (lh_annot, 4, schaefer_LH_Vis_4_annot)),
+         (annot_to_gifti, (lh_annot, lh_label)),
+         (make_binary_gifti, (lh_label, 4, schaefer_LH_Vis_4_label)),
+         (annot_to_func, (lh_annot, lh_func))],
+        [(make_binary_annot, (rh_annot, 4, schaefer_RH_Vis_4_annot)),
+         (annot_to_gifti, (rh_annot, rh_label)),
+         (make_binary_gifti, (rh_label, 4, schaefer_RH_Vis_4_label)),
+         (annot_to_func, (rh_annot, rh_func))],
+        [(yeo_to_91k, (schaef_cifti, mwall, gordon_cifti, schaef_91k)),
+         (dlabel_to_dtseries, (schaef_91k, schaef_91k_dtseries))],
+        [(dlabel_to_dtseries, (schaef_cifti, schaef_dtseries))],
+        [(dlabel_to_dtseries, (gordon_cifti, gordon_dtseries))],
+        [(dlabel_atlas_to_mask, (schaef_cifti, 4, schaefer_LH_Vis_4_mask))],
+        [(dlabel_atlas_to_mask, (gordon_cifti, 273, gordon_L_SMhand_10_mask))],
+    ]
+    # atlas_labels_to_prob dominates the run time, so more than 3 workers
+    # only adds process start-up cost
+    n_workers = min(3, os.cpu_count() or 1)
+    if n_workers == 1:
+        for steps in jobs:
+            _run_steps(steps)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # consume results so that errors in workers are raised here
+            list(executor.map(_run_steps, jobs))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()